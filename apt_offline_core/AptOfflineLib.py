@@ -23,13 +23,22 @@ import os
 import sys
 
 import threading
+import queue
+import concurrent.futures
+import time
+import io
+import json
 
 import zipfile
+import tarfile
+import zlib
 import bz2
 import gzip
 
 import errno
+import re
 import shutil
+import mmap
 
 import warnings
 
@@ -43,6 +52,13 @@ except ImportError:
         sys.stderr.write("WARN: lzma module unavailable\n")
         sys.stderr.write("WARN: Please install python lzma module for APT lzma backend\n")
                 
+#INFO: For the cache fingerprint database
+modSqlite = True
+try:
+        import sqlite3
+except ImportError:
+        modSqlite = False
+
 WindowColor = True
 try:
         import WConio
@@ -58,7 +74,10 @@ try:
         from fcntl import ioctl
         import termios
 except ImportError:
-        pass
+        ioctl = None
+
+#INFO: ioctl to share the data blocks of a file (reflink), on btrfs, xfs and the like. Linux only
+FICLONE = 0x40049409
     
 
 #INFO: Python 2.5 introduces hashlib.
@@ -71,43 +90,242 @@ except ImportError:
         Python_2_5 = False
     
     
+def checksum_entry( checksum ):
+    '''Split checksum, in the signature file format like "SHA256:ab12..",
+    into an (algorithm, digest) pair. algorithm is None when it is unsupported'''
+    (checksumType, digest) = ( checksum.split( ":" ) + [""] )[:2]
+    return ( Checksum.Algorithms.get( checksumType.strip().lower() ), digest.strip().lower() )
+
+
 class Checksum:
-        
+    '''Verify files against their checksums.
+    Files are read once, whatever the number of digests asked for, and in
+    blocks of block_size, so memory use doesn't grow with the file size.'''
+
+    #INFO: The hashes apt may provide, by the names used in signature files
+    Algorithms = { "md5": "md5", "md5sum": "md5", "sha1": "sha1", "sha256": "sha256", "sha512": "sha512" }
+
+    block_size = 1024 * 1024
+
     def HashMessageDigestAlgorithms( self, checksum, HashType, checksumFile ):
             
-        try:
-            data = open( checksumFile, 'rb' )
-            if HashType == "sha256":
-                Hash = self.sha256( data )
-            elif HashType == "md5" or HashType == "md5sum":
-                Hash = self.md5( data )
-            else: Hash = None
-        except IOError:
+        algorithm = self.Algorithms.get( HashType )
+        if algorithm is None:
+            return False
+        Hash = self.digests( checksumFile, [algorithm] )
+        if Hash is None:
             return False
-        data.close()
         
-        if Hash == checksum:
+        if Hash[algorithm] == checksum:
             return True
         return False
     
     def sha256( self, data ):
-        sha256 = hashlib.sha256()
-        sha256.update( data.read() )
-        return sha256.hexdigest()
+        return self.hash_file( data, ["sha256"] )["sha256"]
     
     def md5( self, data ):
-        md5hash = hashlib.md5()
-        md5hash.update( data.read() )
-        return md5hash.hexdigest() 
+        return self.hash_file( data, ["md5"] )["md5"]
+    
+    def digests( self, checksumFile, algorithms ):
+        '''Hex digests of checksumFile for each of algorithms, in one pass.
+        None if checksumFile can't be read'''
+        try:
+            with open( checksumFile, 'rb' ) as data:
+                return self.hash_file( data, algorithms )
+        except (IOError, OSError):
+            return None
+    
+    def hash_file( self, data, algorithms ):
+        '''Hex digests of the file object data for each of algorithms'''
+        algorithms = set( algorithms )
+        if len( algorithms ) == 1 and hasattr( hashlib, "file_digest" ):
+            algorithm = algorithms.pop()
+            return { algorithm: hashlib.file_digest( data, algorithm ).hexdigest() }
+        
+        hashes = dict( ( algorithm, hashlib.new( algorithm ) ) for algorithm in algorithms )
+        if not self.hash_mapped( data, hashes ):
+            buf = bytearray( self.block_size )
+            view = memoryview( buf )
+            while True:
+                count = data.readinto( buf )
+                if not count:
+                    break
+                for Hash in hashes.values():
+                    Hash.update( view[:count] )
+        return dict( ( algorithm, Hash.hexdigest() ) for (algorithm, Hash) in hashes.items() )
+    
+    def hash_mapped( self, data, hashes ):
+        '''Update hashes from an mmap of data. False if data can't be mapped,
+        like an empty file or a pipe'''
+        try:
+            fileno = data.fileno()
+            size = os.fstat( fileno ).st_size - data.tell()
+            mapped = mmap.mmap( fileno, 0, access=mmap.ACCESS_READ )
+        except (AttributeError, IOError, OSError, ValueError):
+            return False
+        try:
+            offset = data.tell()
+            end = offset + size
+            #INFO: Slices of the view hash the pages in place, slices of the mmap would copy them
+            view = memoryview( mapped )
+            try:
+                while offset < end:
+                    block = view[offset:offset + self.block_size]
+                    for Hash in hashes.values():
+                        Hash.update( block )
+                    offset += len( block )
+                    block.release()
+            finally:
+                view.release()
+            data.seek( end )
+        finally:
+            mapped.close()
+        return True
     
     def CheckHashDigest( self, checksumFile, checksum ):
         '''Return Bool against file and its checksum'''
         
-        checksumType = checksum.split(":")[0]
-        checksumType = checksumType.lower()
-        checksum = checksum.split( ":" )[1]
-        return self.HashMessageDigestAlgorithms( checksum, checksumType, checksumFile )
-        
+        (algorithm, digest) = checksum_entry( checksum )
+        if algorithm is None:
+            return False
+        Hash = self.digests( checksumFile, [algorithm] )
+        if Hash is None:
+            return False
+        return Hash[algorithm] == digest
+
+
+class StreamingChecksum:
+    '''Checksum of a payload, computed while its blocks go by.
+    checksum is in the signature file format, like "SHA256:ab12.."'''
+
+    block_size = 65536
+
+    def __init__( self, checksum ):
+        (self.algorithm, self.checksum) = checksum_entry( checksum )
+        if self.algorithm is None:
+            raise ValueError( "unsupported checksum %s" % ( checksum ) )
+        self.reset()
+
+    def reset( self ):
+        self.hash = hashlib.new( self.algorithm )
+
+    def update( self, block ):
+        self.hash.update( block )
+
+    def update_from_file( self, checksumFile, length ):
+        '''Hash the first length bytes of checksumFile, as when resuming a download'''
+        if length <= 0:
+            return
+        with open( checksumFile, 'rb' ) as data:
+            while length > 0:
+                block = data.read( min( self.block_size, length ) )
+                if not block:
+                    break
+                self.update( block )
+                length -= len( block )
+
+    def matches( self ):
+        return self.hash.hexdigest() == self.checksum
+
+
+class CacheFingerprints:
+    '''On-disk database of the files in the cache directories.
+
+    For every verified file it keeps its path, size, mtime and inode along
+    with its sha256/md5 digest. As long as the fingerprint of a file is
+    unchanged, it can be trusted without reading it again.
+    It also keeps the listing of each cache directory, along with the mtime
+    of all its directories, so that an unchanged cache needn't be walked.'''
+
+    Digests = ( "sha256", "md5" )
+
+    def __init__( self, dbFile ):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect( dbFile, check_same_thread=False )
+        with self.db:
+            self.db.execute( "CREATE TABLE IF NOT EXISTS fingerprints (path TEXT PRIMARY KEY, "
+                             "size INTEGER, mtime INTEGER, inode INTEGER, sha256 TEXT, md5 TEXT)" )
+            self.db.execute( "CREATE TABLE IF NOT EXISTS directories (root TEXT, path TEXT, mtime INTEGER, "
+                             "PRIMARY KEY (root, path))" )
+            self.db.execute( "CREATE TABLE IF NOT EXISTS files (root TEXT, name TEXT, path TEXT)" )
+
+    def fingerprint( self, path ):
+        try:
+            st = os.stat( path )
+        except OSError:
+            return None
+        return ( st.st_size, st.st_mtime_ns, st.st_ino )
+
+    def digests( self, checksum ):
+        '''The (column, digest) pairs of checksum that can be kept'''
+        (algorithm, digest) = checksum_entry( checksum )
+        return [ (algorithm, digest) ] if algorithm in self.Digests else []
+
+    def verified( self, path, checksum ):
+        '''Whether path was verified against checksum, like "SHA256:ab12..",
+        and hasn't changed since'''
+        digests = self.digests( checksum )
+        fingerprint = self.fingerprint( path )
+        if not digests or fingerprint is None:
+            return False
+        with self.lock:
+            row = self.db.execute( "SELECT size, mtime, inode, %s FROM fingerprints WHERE path = ?" %
+                                   ( ", ".join( self.Digests ) ), ( path, ) ).fetchone()
+        if row is None or tuple( row[:3] ) != fingerprint:
+            return False
+        known = dict( zip( self.Digests, row[3:] ) )
+        for (column, digest) in digests:
+            if known[column] != digest:
+                return False
+        return True
+
+    def record( self, path, checksum ):
+        '''Remember that path matches checksum'''
+        digests = self.digests( checksum )
+        fingerprint = self.fingerprint( path )
+        if not digests or fingerprint is None:
+            return
+        with self.lock, self.db:
+            row = self.db.execute( "SELECT size, mtime, inode FROM fingerprints WHERE path = ?", ( path, ) ).fetchone()
+            if row is None or tuple( row ) != fingerprint:
+                #INFO: A new or changed file. Whatever was known about it is stale
+                self.db.execute( "INSERT OR REPLACE INTO fingerprints (path, size, mtime, inode) VALUES (?, ?, ?, ?)",
+                                 ( path, ) + fingerprint )
+            for (column, digest) in digests:
+                self.db.execute( "UPDATE fingerprints SET %s = ? WHERE path = ?" % ( column ), ( digest, path ) )
+
+    def load_index( self, root ):
+        '''The filename to paths map of root, as saved by save_index().
+        None when a directory of root has changed since'''
+        with self.lock:
+            directories = self.db.execute( "SELECT path, mtime FROM directories WHERE root = ?", ( root, ) ).fetchall()
+            if not directories:
+                return None
+            for (path, mtime) in directories:
+                try:
+                    if os.stat( path ).st_mtime_ns != mtime:
+                        return None
+                except OSError:
+                    return None
+            index = {}
+            for (name, path) in self.db.execute( "SELECT name, path FROM files WHERE root = ? ORDER BY rowid", ( root, ) ):
+                index.setdefault( name, [] ).append( path )
+        return index
+
+    def save_index( self, root, index, directories ):
+        '''directories maps each directory of root to its mtime'''
+        with self.lock, self.db:
+            self.db.execute( "DELETE FROM directories WHERE root = ?", ( root, ) )
+            self.db.execute( "DELETE FROM files WHERE root = ?", ( root, ) )
+            self.db.executemany( "INSERT INTO directories VALUES (?, ?, ?)",
+                                 [ ( root, path, mtime ) for (path, mtime) in directories.items() ] )
+            self.db.executemany( "INSERT INTO files VALUES (?, ?, ?)",
+                                 [ ( root, name, path ) for (name, paths) in index.items() for path in paths ] )
+
+    def close( self ):
+        with self.lock:
+            self.db.close()
+
 
 class Log:
         '''
@@ -342,6 +560,13 @@ class ProgressBar( object ):
                         self.items = self.items + 1
                 self.display()
         
+        def removeItem( self, maxValue ):
+                #Undo addItem(), for an item that will be added again
+                self.max = self.max - maxValue
+                self.span = float( self.max - self.min )
+                if self.items_update is True:
+                        self.items = self.items - 1
+        
         def display( self ):
                 sys.stdout.write("\r%3s / %3s items: %s\r" % ( self.complete, self.items, str( self ) ))
         
@@ -369,7 +594,93 @@ class AptOfflineLibShutilError(Exception):
     def __init__(self, message):
         Exception.__init__(self, message)
         
+#INFO: Leading bytes of the payloads that are compressed already:
+# debs (ar), xz, gzip, bzip2, zstd and lzma
+CompressedMagic = ( ( b"!<arch>\n", "deb" ), ( b"\xfd7zXZ\x00", "xz" ), ( b"\x1f\x8b", "gzip" ), ( b"BZh", "bzip2" ),
+                    ( b"\x28\xb5\x2f\xfd", "zstd" ), ( b"\x5d\x00\x00", "lzma" ) )
+
+#INFO: The files of source packages, by their names
+SourcePackageFile = re.compile( r"^[^_/]+_[^_/]+\.(dsc|diff\.gz|tar\.\w+)(\.asc)?$" )
+
+def payload_format( fileName ):
+        '''The compressed format of fileName, from its leading bytes.
+        None when it isn't compressed'''
+        try:
+                with open( fileName, 'rb' ) as data:
+                        head = data.read( 8 )
+        except (IOError, OSError):
+                return None
+        for (magic, payloadFormat) in CompressedMagic:
+                if head.startswith( magic ):
+                        return payloadFormat
+        return None
+
+def member_compression( fileName ):
+        '''The zip compression for fileName. Deflating a payload that is
+        compressed already costs CPU on both ends and gains nothing, so
+        those are stored as they are'''
+        if payload_format( fileName ) is None:
+                return zipfile.ZIP_DEFLATED
+        return zipfile.ZIP_STORED
+
+def bug_subject( data ):
+        '''The subject of the bug report in the binary file object data,
+        without the "Subject:" header name'''
+        for line in data:
+                line = line.decode( 'utf-8', 'replace' )
+                if line.startswith( "Subject:" ):
+                        return line[len( "Subject:" ):].strip()
+        return ""
+
+
+def describe_member( fileName, name, bug_suffix=None ):
+        '''The manifest entry of fileName, added to a bundle as name.
+        It has the role of the file (deb, source, index, signature, bug or
+        changelog), the package and version it belongs to when there are
+        some, its size, compressed format and sha256'''
+        entry = { "name": name, "size": os.path.getsize( fileName ), "format": payload_format( fileName ) }
+        if bug_suffix and name.endswith( bug_suffix ):
+                entry["role"] = "bug"
+                entry["package"] = name.split( "{}" )[0]
+                with open( fileName, 'rb' ) as data:
+                        entry["subject"] = bug_subject( data )
+        elif name.endswith( ".changelog" ):
+                entry["role"] = "changelog"
+                entry["package"] = name[:-len( ".changelog" )]
+        elif name.endswith( ".deb" ) or name.endswith( ".udeb" ):
+                entry["role"] = "deb"
+                ( entry["package"], entry["version"] ) = ( name.split( "_" ) + [ "", "" ] )[:2]
+                entry["version"] = entry["version"].replace( "%3a", ":" )
+        elif SourcePackageFile.match( name ):
+                entry["role"] = "source"
+                ( entry["package"], entry["version"] ) = name.split( "_" )[:2]
+                entry["version"] = re.sub( r"\.(dsc|diff\.gz|(orig|debian)?\.?tar\..*)$", "", entry["version"] )
+                if name.endswith( ".dsc" ):
+                        #INFO: The files of the source package, as listed in the .dsc
+                        entry["files"] = []
+                        marker = False
+                        with open( fileName, 'rb' ) as data:
+                                for line in data:
+                                        line = line.decode( 'utf-8', 'replace' )
+                                        if line.startswith( "Files:" ):
+                                                marker = True
+                                        elif marker and line.startswith( " " ) and line.split():
+                                                entry["files"].append( line.split()[-1] )
+                                        elif marker:
+                                                break
+        elif name.endswith( "Release.gpg" ) or name.endswith( "InRelease" ):
+                entry["role"] = "signature"
+        else:
+                entry["role"] = "index"
+        entry["sha256"] = Checksum().digests( fileName, [ "sha256" ] )["sha256"]
+        return entry
+
+
 class Archiver:
+
+        #INFO: Bytes decompress_the_file() decompresses at a time
+        decompress_buffer_size = 1024 * 1024
+
         def __init__( self, lock=None ):
                 if lock is None or lock != 1:
                         self.ZipLock = False
@@ -381,10 +692,27 @@ class Archiver:
                 # for the same src package
                 # https://github.com/rickysarraf/apt-offline/issues/44
                 self.file_possibly_deleted = False
+                #INFO: A BundleWriter. When set, files for its archive are handed over to it
+                self.BundleWriter = None
+                #INFO: Deflate level of the members that get compressed. None is zlib's default
+                self.compresslevel = None
+                #INFO: ( bytes written, seconds taken ) of the last decompression
+                self.decompress_stats = None
                 
         def TarGzipBZ2_Uncompress( self, SourceFileHandle, TargetFileHandle ):
+                '''Decompress SourceFileHandle to TargetFileHandle, decompress_buffer_size
+                bytes at a time'''
+                started = time.time()
+                written = 0
+                buf = bytearray( self.decompress_buffer_size )
+                view = memoryview( buf )
                 try:
-                        TargetFileHandle.write( SourceFileHandle.read() )
+                        while True:
+                                count = SourceFileHandle.readinto( buf )
+                                if not count:
+                                        break
+                                TargetFileHandle.write( view[:count] )
+                                written += count
                 except EOFError:
                         pass
                 except IOError:
@@ -397,11 +725,16 @@ class Archiver:
                         # The safest bet at the moment is to simply discard such files, which were
                         # downloaded in damaged form.
                         return False
+                self.decompress_stats = ( written, time.time() - started )
                 return True
         
         def compress_the_file( self, zip_file_name, files_to_compress ):
                 '''Condenses all the files into one single file for easy transfer'''
 
+                if self.BundleWriter is not None and self.BundleWriter.zip_file_name == zip_file_name:
+                        self.BundleWriter.add( files_to_compress )
+                        return True
+
                 try:
                         if self.lock:
                                 self.ZipLock.acquire( True )
@@ -424,7 +757,8 @@ class Archiver:
                         warnings.filterwarnings('error')
 
                         try:
-                                filename.write( files_to_compress, os.path.basename( files_to_compress ), zipfile.ZIP_DEFLATED )
+                                filename.write( files_to_compress, os.path.basename( files_to_compress ),
+                                                member_compression( files_to_compress ), self.compresslevel )
                         except OSError as e:
                                 if e.errno == errno.ENOENT:
                                         #INFO: We could be here, because in another thread (amd64), it completed, i.e. wrote to the archive and removed
@@ -446,7 +780,8 @@ class Archiver:
                         return False
 
         def decompress_the_file( self, archive_file, target_file, archive_type ):
-                '''Extracts all the files from a single condensed archive file'''
+                '''Extracts all the files from a single condensed archive file.
+                archive_file is a file name or a binary file object'''
                 if archive_type == "bzip2" or archive_type == "gzip" or archive_type == "xz":
                         if archive_type == "bzip2":
                                 try:
@@ -455,7 +790,7 @@ class Archiver:
                                         return False
                         elif archive_type == "gzip":
                                 try:
-                                        read_from = gzip.GzipFile( archive_file, 'r' )
+                                        read_from = gzip.open( archive_file, 'rb' )
                                 except IOError:
                                         return False
                         elif archive_type == "xz":
@@ -505,8 +840,338 @@ class Archiver:
                 else:
                         return False
 
+
+class BundleWriter( threading.Thread ):
+        '''Single writer of a bundle file.
+
+        It keeps the zip archive open for the whole run and adds to it the
+        files handed over by add(), in the order they come. The download
+        threads only wait on it when queue_size files are pending.
+        close() finalizes the archive, once, after the pending files.
+
+        Every archive ends with a manifest, which describes its members
+        with describe_member(). bug_suffix is the file name suffix of the
+        bug reports.
+
+        With a volume_size, the bundle is split in volumes of at most that
+        many bytes, named like bundle.1.zip, bundle.2.zip. Every file goes
+        to the first volume it fits in (first fit bin-packing) and every
+        volume gets a manifest of its own, so that each volume can be
+        installed by itself, in any order.
+
+        The work that doesn't touch the archive, describing the files and
+        deflating the small ones, is done ahead by a pool of compress_workers
+        threads. Only the writes into the archive are serialized.
+
+        When writing fails unexpectedly, the writer keeps draining the queue,
+        so that add() never blocks, and close() raises AptOfflineErrors.'''
+
+        #INFO: Name of the manifest member of a bundle
+        manifest_name = "apt-offline-manifest.json"
+
+        #INFO: Smallest volume size, with room for the end of the archive and the manifest
+        volume_minimum = 65536
+
+        #INFO: How much the compression of a whole volume can grow incompressible
+        # data, as a ratio and a number of bytes. A zip volume isn't compressed as a whole
+        growth = ( 0, 0 )
+
+        #INFO: Suffixes kept at the end of the volume names
+        suffixes = ( ".tar.gz", ".tar.bz2", ".tar.xz", ".tgz", ".tbz2", ".txz", ".tar", ".zip" )
+
+        #INFO: Members to be deflated, up to deflate_limit bytes, are deflated in the pool
+        deflate_members = True
+        deflate_limit = 4 * 1024 * 1024
+
+        #INFO: zipfile has no public API for data compressed elsewhere. add_deflated()
+        # uses these internals of ZipFile, and ZipFile.write() compresses when they are missing
+        zipfile_internals = ( "fp", "start_dir", "filelist", "NameToInfo", "_writecheck", "_didModify", "_seekable", "_writing" )
+
+        def __init__( self, zip_file_name, queue_size=16, compresslevel=None, fileobj=None, volume_size=None, bug_suffix=None,
+                      compress_workers=None ):
+                threading.Thread.__init__( self, name="BundleWriter" )
+                self.daemon = True
+                self.zip_file_name = zip_file_name
+                self.compresslevel = compresslevel
+                #INFO: An already open binary stream to write to, instead of zip_file_name
+                self.fileobj = fileobj
+                self.volume_size = volume_size
+                self.bug_suffix = bug_suffix
+                workers = compress_workers or os.cpu_count() or 1
+                #INFO: Enough files queued ahead to keep every worker of the pool busy
+                self.queue = queue.Queue( max( queue_size, 2 * workers ) )
+                self.names = set()
+                #INFO: Warnings for the files that couldn't be added, for the caller to report
+                self.errors = []
+                #INFO: The exception the writer failed with, if it did
+                self.failure = None
+                #INFO: Each volume is a dict of its file name, archive, bytes used and manifest entries
+                self.volumes = []
+                self.closed = False
+                #INFO: zlib and hashlib release the GIL, so threads do
+                self.pool = concurrent.futures.ThreadPoolExecutor( workers, thread_name_prefix="BundleWorker" )
+                self.new_volume()
+                if self.deflate_members and not self.takes_deflated( self.volumes[0]["archive"] ):
+                        self.deflate_members = False
+                self.start()
+
+        def open( self, target ):
+                return zipfile.ZipFile( target, "w", allowZip64=True )
+
+        def add_member( self, archive, fileName, name ):
+                archive.write( fileName, name, member_compression( fileName ), self.compresslevel )
+
+        def add_data( self, archive, name, data ):
+                archive.writestr( name, data, zipfile.ZIP_DEFLATED )
+
+        def takes_deflated( self, archive ):
+                '''Whether add_deflated() can work with archive'''
+                return all( hasattr( archive, attribute ) for attribute in self.zipfile_internals ) and \
+                        hasattr( zipfile.ZipInfo, "FileHeader" )
+
+        def add_deflated( self, archive, fileName, name, deflated ):
+                '''Add fileName as name, from its data deflated beforehand.
+                deflated is a (size, CRC, raw deflate data) tuple'''
+                ( size, crc, compressed ) = deflated
+                zinfo = zipfile.ZipInfo.from_file( fileName, name )
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                zinfo.file_size = size
+                zinfo.compress_size = len( compressed )
+                zinfo.CRC = crc
+                #INFO: zipfile can't take data compressed elsewhere. The member is laid
+                # out like ZipFile.open() does it, with the sizes known up front
+                if archive._writing:
+                        raise ValueError( "Can't add %s while a member is open for writing" % ( name ) )
+                if archive._seekable:
+                        archive.fp.seek( archive.start_dir )
+                zinfo.header_offset = archive.fp.tell()
+                archive._writecheck( zinfo )
+                archive._didModify = True
+                archive.fp.write( zinfo.FileHeader( False ) )
+                archive.fp.write( compressed )
+                archive.start_dir = archive.fp.tell()
+                archive.filelist.append( zinfo )
+                archive.NameToInfo[name] = zinfo
+
+        def prepare( self, fileName ):
+                '''The manifest entry of fileName, and its deflated data when it is
+                a small member to be deflated, else None. Runs in the pool'''
+                entry = describe_member( fileName, os.path.basename( fileName ), self.bug_suffix )
+                if not self.deflate_members or entry["size"] > self.deflate_limit or \
+                   member_compression( fileName ) != zipfile.ZIP_DEFLATED:
+                        return ( entry, None )
+                with open( fileName, 'rb' ) as data:
+                        payload = data.read()
+                level = zlib.Z_DEFAULT_COMPRESSION if self.compresslevel is None else self.compresslevel
+                compressor = zlib.compressobj( level, zlib.DEFLATED, -15 )
+                compressed = compressor.compress( payload ) + compressor.flush()
+                return ( entry, ( len( payload ), zlib.crc32( payload ), compressed ) )
+
+        def volume_name( self, index ):
+                '''File name of volume number index'''
+                for suffix in self.suffixes:
+                        if self.zip_file_name.endswith( suffix ):
+                                return "%s.%d%s" % ( self.zip_file_name[:-len( suffix )], index, suffix )
+                return "%s.%d" % ( self.zip_file_name, index )
+
+        def new_volume( self ):
+                if self.volume_size:
+                        fileName = self.volume_name( len( self.volumes ) + 1 )
+                        target = fileName
+                else:
+                        fileName = self.zip_file_name
+                        target = self.fileobj or self.zip_file_name
+                volume = { "name": fileName, "archive": self.open( target ), "used": 0, "files": [] }
+                self.volumes.append( volume )
+                return volume
+
+        def manifest_size( self, entry ):
+                '''Bytes entry takes in the manifest, at its depth in the list of files'''
+                text = json.dumps( entry, indent=1 )
+                return len( text.encode( "utf-8" ) ) + 2 * ( text.count( "\n" ) + 1 ) + len( ",\n" )
+
+        def stored_size( self, fileName, entry, deflated ):
+                '''Bytes the data of fileName takes in the archive'''
+                if deflated is not None:
+                        return len( deflated[2] )
+                if member_compression( fileName ) == zipfile.ZIP_DEFLATED:
+                        #INFO: Deflate grows incompressible data by a few bytes every 16 KiB
+                        return entry["size"] + ( entry["size"] >> 11 ) + 64
+                return entry["size"]
+
+        def member_overhead( self, name, size ):
+                '''Bytes a member of size bytes takes on top of its data: its local
+                header, data descriptor and central directory entry'''
+                length = len( name.encode( "utf-8" ) )
+                #INFO: Both headers may carry a zip64 extra field
+                return zipfile.sizeFileHeader + length + 20 + 24 + zipfile.sizeCentralDir + length + 28
+
+        def archive_overhead( self ):
+                '''Bytes of a volume besides its members and their manifest entries: the
+                manifest member and the end of the archive'''
+                manifest = { "files": [], "volume": 10 ** 6, "volumes": 10 ** 6 }
+                return self.member_overhead( self.manifest_name, 0 ) + len( json.dumps( manifest, indent=1 ) ) + \
+                        zipfile.sizeEndCentDir + zipfile.sizeEndCentDir64 + zipfile.sizeEndCentDir64Locator
+
+        def capacity( self ):
+                '''Bytes of a volume that the members and their manifest entries can take'''
+                ( ratio, extra ) = self.growth
+                return int( ( self.volume_size - extra ) / ( 1 + ratio ) ) - self.archive_overhead()
+
+        def volume_for( self, name, size, entry ):
+                '''The volume a member of size bytes, described by entry, goes to'''
+                if not self.volume_size:
+                        return self.volumes[0]
+                size += self.member_overhead( name, size ) + self.manifest_size( entry )
+                capacity = self.capacity()
+                for volume in self.volumes:
+                        if volume["used"] + size <= capacity:
+                                break
+                else:
+                        if size > capacity:
+                                self.errors.append( "%s is bigger than the volume size. It gets a volume of its own\n" % ( name ) )
+                        volume = self.new_volume()
+                volume["used"] += size
+                return volume
+
+        def add( self, fileName, remove=False ):
+                '''Queue fileName to be added to the archive.
+                With remove, fileName is deleted once it has been added'''
+                if self.failure is not None:
+                        return
+                self.queue.put( ( fileName, remove, self.pool.submit( self.prepare, fileName ) ) )
+
+        def run( self ):
+                while True:
+                        item = self.queue.get()
+                        if item is None:
+                                break
+                        if self.failure is not None:
+                                continue
+                        try:
+                                self.write( *item )
+                        except Exception as e:
+                                #INFO: Keep draining the queue, else the download threads block in add()
+                                self.failure = e
+
+        def write( self, fileName, remove, prepared ):
+                name = os.path.basename( fileName )
+                if name in self.names:
+                        #INFO: Multiarch packages can share a name. The first one wins
+                        self.errors.append( "Ignoring duplicate file %s\n" % ( name ) )
+                        return
+                try:
+                        ( entry, deflated ) = prepared.result()
+                        volume = self.volume_for( name, self.stored_size( fileName, entry, deflated ), entry )
+                        if deflated is None:
+                                self.add_member( volume["archive"], fileName, name )
+                        else:
+                                self.add_deflated( volume["archive"], fileName, name, deflated )
+                        volume["files"].append( entry )
+                        self.names.add( name )
+                        if remove:
+                                os.unlink( fileName )
+                except (OSError, zipfile.LargeZipFile, tarfile.TarError, ValueError) as e:
+                        self.errors.append( "Failed to add %s to %s: %s\n" % ( fileName, self.zip_file_name, e ) )
+
+        def close( self ):
+                '''Write the pending files, then the manifests and the archives' directories'''
+                if self.closed:
+                        return
+                self.closed = True
+                self.queue.put( None )
+                self.join()
+                self.pool.shutdown()
+                if self.failure is not None:
+                        for volume in self.volumes:
+                                try:
+                                        volume["archive"].close()
+                                except Exception:
+                                        pass
+                        if self.fileobj is not None:
+                                self.fileobj.close()
+                        raise AptOfflineErrors( "Failed to write %s: %s\n" % ( self.zip_file_name, self.failure ) ) from self.failure
+                for (index, volume) in enumerate( self.volumes ):
+                        manifest = { "files": volume["files"] }
+                        if self.volume_size:
+                                manifest["volume"] = index + 1
+                                manifest["volumes"] = len( self.volumes )
+                        try:
+                                self.add_data( volume["archive"], self.manifest_name, json.dumps( manifest, indent=1 ).encode( "utf-8" ) )
+                        except (OSError, tarfile.TarError, ValueError) as e:
+                                self.errors.append( "Failed to add the manifest to %s: %s\n" % ( volume["name"], e ) )
+                        volume["archive"].close()
+                if self.fileobj is not None:
+                        self.fileobj.close()
+
+
+class TarBundleWriter( BundleWriter ):
+        '''BundleWriter of a tar bundle, optionally compressed as a whole.
+
+        Members are written one after the other and nothing is ever seeked
+        back to, so the bundle can go to a pipe, a tape or a split stream.
+        It can also be read back in a single pass.'''
+
+        Modes = { "tar": "w|", "tar.gz": "w|gz", "tar.bz2": "w|bz2", "tar.xz": "w|xz" }
+
+        #INFO: A compressed tar bundle is compressed as a whole, by the writer
+        deflate_members = False
+
+        #INFO: Worst growth of incompressible data by each compression, as a ratio
+        # and a number of bytes: gzip's stored blocks, bzip2's bound and xz's
+        # uncompressed chunks, with their headers
+        Growth = { "tar": ( 0, 0 ), "tar.gz": ( 5.0 / 16384, 1024 ), "tar.bz2": ( 0.01, 1024 ), "tar.xz": ( 3.0 / 65536, 1024 ) }
+
+        def __init__( self, zip_file_name, bundle_format="tar", queue_size=16, fileobj=None, volume_size=None, bug_suffix=None ):
+                self.bundle_format = bundle_format
+                self.growth = self.Growth[bundle_format]
+                BundleWriter.__init__( self, zip_file_name, queue_size=queue_size, fileobj=fileobj, volume_size=volume_size,
+                                       bug_suffix=bug_suffix )
+
+        def open( self, target ):
+                if isinstance( target, str ):
+                        return tarfile.open( target, mode=self.Modes[self.bundle_format] )
+                return tarfile.open( fileobj=target, mode=self.Modes[self.bundle_format] )
+
+        def add_member( self, archive, fileName, name ):
+                archive.add( fileName, name, recursive=False )
+
+        def stored_size( self, fileName, entry, deflated ):
+                return entry["size"]
+
+        def member_overhead( self, name, size ):
+                '''Bytes a member of size bytes takes on top of its data: its header
+                block, a pax header, and the padding of its data to a whole block'''
+                #INFO: tarfile writes a pax header of the fractional mtime, and of a long name
+                records = 64
+                length = len( name.encode( "utf-8" ) )
+                if length > 100 or not name.isascii():
+                        records += length + 16
+                records += -records % tarfile.BLOCKSIZE
+                return 2 * tarfile.BLOCKSIZE + records + -size % tarfile.BLOCKSIZE
+
+        def archive_overhead( self ):
+                '''Bytes of a volume besides its members and their manifest entries:
+                the manifest member, and the end of the archive, which is padded to a
+                whole record'''
+                manifest = { "files": [], "volume": 10 ** 6, "volumes": 10 ** 6 }
+                return tarfile.BLOCKSIZE - 1 + self.member_overhead( self.manifest_name, 0 ) + \
+                        len( json.dumps( manifest, indent=1 ) ) + 2 * tarfile.BLOCKSIZE + tarfile.RECORDSIZE
+
+        def add_data( self, archive, name, data ):
+                member = tarfile.TarInfo( name )
+                member.size = len( data )
+                member.mtime = int( time.time() )
+                member.mode = 0o644
+                archive.addfile( member, io.BytesIO( data ) )
+
+
 class FileMgmt( object ):
         
+        #INFO: copy_file() may hardlink the file rather than copying it
+        hardlink = False
+        copy_buffer_size = 1024 * 1024
+        
         def __init__( self ):
                 self.duplicate_files = []
 
@@ -560,26 +1225,123 @@ class FileMgmt( object ):
                 raise AptOfflineLibShutilError("Possbile duplicate file %s already present in %s\n" % (src, dest))
             return True
                 
-        def copy_file(self, src, dest):
-            '''Copy file from src to dest'''
+        def copy_file(self, src, dest, preserve=False):
+            '''Copy file from src to dest directory'''
             try:
-                #INFO: If src and dest are the same, it is effectively opening the same file
-                # in read and write modes, which leads to NULL data corruption
-                destFile = os.path.join(dest, os.path.basename(src))
-                srcFile = os.path.abspath(src)
-                #print(srcFile, destFile)
-                if srcFile == destFile:
-                    return True
-                SFH = open(srcFile, 'rb')
-                DFH = open(destFile, 'wb')
-                
-                DFH.write(SFH.read())
-                DFH.flush()
-                DFH.close()
-                SFH.close()
-            except IOError:
-                SFH.close()
+                self.copy_to(src, os.path.join(dest, os.path.basename(src)), preserve)
+            except (IOError, OSError):
                 return False
+            return True
+
+        def copy_to(self, srcFile, destFile, preserve=False):
+            '''Copy file srcFile to destFile, the cheapest way that works:
+            a reflink, a hardlink (when self.hardlink allows), a copy in the
+            kernel, or else a copy through a bounded buffer.
+            preserve keeps the mode and times, like shutil.copy2().
+            Raises IOError/OSError on failure.'''
+            #INFO: If src and dest are the same, it is effectively opening the same file
+            # in read and write modes, which leads to NULL data corruption.
+            # A hardlink made by an earlier run is the same file too
+            if os.path.abspath(srcFile) == os.path.abspath(destFile):
+                return
+            try:
+                if os.path.samefile(srcFile, destFile):
+                    return
+            except OSError:
+                pass
+            with open(srcFile, 'rb') as SFH:
+                with open(destFile, 'wb') as DFH:
+                    if self.reflink_file(SFH, DFH):
+                        copied = True
+                    elif not self.hardlink:
+                        self.copy_data(SFH, DFH)
+                        copied = True
+                    else:
+                        copied = False
+                if not copied:
+                    if self.link_file(srcFile, destFile):
+                        return
+                    with open(destFile, 'wb') as DFH:
+                        self.copy_data(SFH, DFH)
+            if preserve:
+                shutil.copystat(srcFile, destFile)
+
+        def reflink_file(self, SFH, DFH):
+            '''Make DFH share the data blocks of SFH'''
+            if ioctl is None or not sys.platform.startswith("linux"):
+                return False
+            try:
+                ioctl(DFH.fileno(), FICLONE, SFH.fileno())
+            except (IOError, OSError):
+                return False
+            return True
+
+        def link_file(self, srcFile, destFile):
+            try:
+                os.unlink(destFile)
+            except OSError:
+                pass
+            try:
+                os.link(srcFile, destFile)
+            except OSError:
+                return False
+            return True
+
+        def copy_stream(self, source, destFile):
+            '''Copy the binary file object source to destFile, through a bounded
+            buffer. The data goes to a temporary name next to destFile, which
+            is renamed in place once complete.
+            Raises IOError/OSError on failure.'''
+            tempFile = "%s.%d.tmp" % (destFile, os.getpid())
+            try:
+                with open(tempFile, 'wb') as DFH:
+                    shutil.copyfileobj(source, DFH, self.copy_buffer_size)
+                os.rename(tempFile, destFile)
+            except:
+                try:
+                    os.unlink(tempFile)
+                except OSError:
+                    pass
+                raise
+
+        def copy_data(self, SFH, DFH):
+            '''Copy the data of SFH to DFH, in the kernel with
+            copy_file_range() or sendfile() where possible'''
+            size = os.fstat(SFH.fileno()).st_size
+            for kernel_copy in (self.copy_file_range, self.sendfile):
+                try:
+                    if kernel_copy(SFH.fileno(), DFH.fileno(), size):
+                        return
+                except (IOError, OSError):
+                    pass
+                #INFO: Not supported here, or only half done. Start over the next way
+                DFH.seek(0)
+                DFH.truncate()
+
+            SFH.seek(0)
+            shutil.copyfileobj(SFH, DFH, self.copy_buffer_size)
+
+        def copy_file_range(self, src, dest, size):
+            if not hasattr(os, "copy_file_range"):
+                return False
+            offset = 0
+            while offset < size:
+                copied = os.copy_file_range(src, dest, size - offset, offset, offset)
+                if copied == 0:
+                    return False
+                offset += copied
+            return True
+
+        def sendfile(self, src, dest, size):
+            if not hasattr(os, "sendfile"):
+                return False
+            offset = 0
+            while offset < size:
+                copied = os.sendfile(dest, src, offset, size - offset)
+                if copied == 0:
+                    return False
+                offset += copied
+            return True
             
         def move_folder( self, src, dest ):
                 '''Move folder from src to dest.'''
@@ -626,10 +1388,186 @@ class FileMgmt( object ):
     
                 return self.duplicate_files
 
+class CacheIndex( FileMgmt ):
+        '''Filename to path(s) map of a cache directory.
+
+        The directory is walked once, on the first lookup, instead of once per
+        lookup. The map is shared by all the threads and kept up to date with
+        add() as files get written to the cache.'''
+
+        def __init__( self, cache_dir=None, fingerprints=None ):
+                FileMgmt.__init__( self )
+                self.cache_dir = cache_dir
+                #INFO: A CacheFingerprints, to keep the map across runs
+                self.fingerprints = fingerprints
+                self.index = None
+                self.lock = threading.Lock()
+
+        def build( self ):
+                '''Walk the cache directory, unless the saved map of it is still
+                good. Call with the lock held'''
+                self.index = {}
+                if self.cache_dir is None or os.path.isdir( self.cache_dir ) is False:
+                        return
+                root = os.path.abspath( self.cache_dir )
+                if self.fingerprints is not None:
+                        index = self.fingerprints.load_index( root )
+                        if index is not None:
+                                self.index = index
+                                return
+
+                directories = {}
+                for path, folders, files in os.walk( root ):
+                        directories[path] = os.stat( path ).st_mtime_ns
+                        for f in files:
+                                self.index.setdefault( f, [] ).append( os.path.join( path, f ) )
+                if self.fingerprints is not None:
+                        self.fingerprints.save_index( root, self.index, directories )
+
+        def find_first_match( self, cache_dir=None, filename=None ):
+                '''Drop-in replacement for FileMgmt.find_first_match()'''
+                if filename is None or cache_dir != self.cache_dir:
+                        return FileMgmt.find_first_match( self, cache_dir, filename )
+
+                with self.lock:
+                        if self.index is None:
+                                self.build()
+                        paths = list( self.index.get( filename, [] ) )
+                for path in paths:
+                        #INFO: The file may have been removed since the walk
+                        if os.path.isfile( path ):
+                                return path
+                        self.discard( path )
+                return False
+
+        def add( self, path ):
+                with self.lock:
+                        if self.index is None:
+                                return
+                        paths = self.index.setdefault( os.path.basename( path ), [] )
+                        if path not in paths:
+                                paths.append( path )
+
+        def discard( self, path ):
+                with self.lock:
+                        paths = self.index.get( os.path.basename( path ), [] )
+                        if path in paths:
+                                paths.remove( path )
+
+
+class ByteCounter:
+        '''Count of the bytes received from the network, added to by all
+        the download threads at once. Calling it returns the count'''
+
+        def __init__( self ):
+                self.value = 0
+                self.lock = threading.Lock()
+
+        def add( self, length ):
+                with self.lock:
+                        self.value += length
+
+        def __call__( self ):
+                return self.value
+
+
+class AdaptiveConcurrency:
+        '''Decide how many worker threads may download at once, AIMD style.
+
+        Every interval seconds the aggregate throughput, the per connection
+        throughput and the rate of timeouts/retries are sampled. With no
+        errors, one more worker is let in (additive increase), as long as that
+        pays off in throughput. When the retry rate goes up, the number of
+        workers is halved (multiplicative decrease).
+        progress is a callable returning the bytes received so far, like a
+        ByteCounter. The progress bar's value won't do: it is clamped, and it
+        counts cache hits and finished items too.'''
+
+        HoldIntervals = 3
+        MaxRetryRate = 0.1
+
+        def __init__( self, progress, minimum=1, maximum=8, interval=5.0 ):
+                self.progress = progress
+                self.minimum = max( 1, minimum )
+                self.maximum = max( self.minimum, maximum )
+                self.interval = interval
+                self.limit = self.minimum
+                self.active = 0
+                self.condition = threading.Condition()
+
+                self.lastTime = time.time()
+                self.lastBytes = progress()
+                self.lastRate = 0.0
+                self.peakRate = 0.0
+                self.started = 0
+                self.errors = 0
+                self.grew = False
+                self.hold = 0
+                self.history = []
+
+        def acquire( self ):
+                '''Block until the worker may start its next item'''
+                with self.condition:
+                        while self.active >= self.limit:
+                                self.condition.wait( self.interval )
+                                self.adjust()
+                        self.active += 1
+                        self.started += 1
+
+        def release( self ):
+                with self.condition:
+                        self.active -= 1
+                        self.adjust()
+                        self.condition.notify_all()
+
+        def failed( self ):
+                '''Count a timeout or retry'''
+                with self.condition:
+                        self.errors += 1
+
+        def adjust( self ):
+                '''Resize the limit, once per interval. Call with the condition held'''
+                now = time.time()
+                elapsed = now - self.lastTime
+                if elapsed < self.interval:
+                        return
+                transferred = self.progress()
+                rate = max( 0.0, ( transferred - self.lastBytes ) / elapsed )
+                perConnection = rate / max( 1, self.active )
+                retryRate = self.errors / max( 1, self.started + self.active )
+                limit = self.limit
+
+                if retryRate > self.MaxRetryRate:
+                        limit = max( self.minimum, self.limit // 2 )
+                        self.hold = self.HoldIntervals
+                elif self.grew and rate < self.lastRate * 1.05:
+                        #INFO: The last worker let in didn't make things faster. Step back
+                        limit = max( self.minimum, self.limit - 1 )
+                        self.hold = self.HoldIntervals
+                elif self.hold > 0:
+                        self.hold -= 1
+                else:
+                        limit = min( self.maximum, self.limit + 1 )
+
+                self.grew = limit > self.limit
+                if limit != self.limit:
+                        self.history.append( ( now, limit, rate, perConnection, retryRate ) )
+                self.limit = limit
+                self.peakRate = max( self.peakRate, rate )
+                self.lastRate = rate
+                self.lastTime = now
+                self.lastBytes = transferred
+                self.started = 0
+                self.errors = 0
+                self.condition.notify_all()
+
+
 class MyThread( threading.Thread ):
         """My thread class"""
-        def __init__( self, WorkerFunction, requestQueue=None, responseQueue=None, NumOfThreads=1 ):
+        def __init__( self, WorkerFunction, requestQueue=None, responseQueue=None, NumOfThreads=1, Concurrency=None ):
                 # Pool of NUMTHREADS Threads that run run().
+                # With an AdaptiveConcurrency, only as many of them as it allows work at once
+                self.Concurrency = Concurrency
                 self.requestQueue = requestQueue
                 self.responseQueue = responseQueue
                 self.threads = NumOfThreads
@@ -674,13 +1612,13 @@ class MyThread( threading.Thread ):
                         else:
                                 # let threads also lookout for gui signals of cancellation
                                 thread.join(timeout)
-                                if not thread.isAlive():
+                                if not thread.is_alive():
                                         self.threads_finished += 1
                         
         def run( self, item=None):
                 while True:
-                        if threading.currentThread().guiTerminateSignal:
-                                #print threading.currentThread().getName(), "has been stopped :D"
+                        if threading.current_thread().guiTerminateSignal:
+                                #print threading.current_thread().name, "has been stopped :D"
                                 break
                         if self.requestQueue is not None:
                                 item = self.requestQueue.get()
@@ -688,11 +1626,20 @@ class MyThread( threading.Thread ):
                         if item is None:
                                 break
                                 
-                        thread_name = threading.currentThread().getName()
+                        thread_name = threading.current_thread().name
                         
-                        if self.responseQueue is not None:
-                                self.responseQueue.put( self.WorkerFunction( item, thread_name ) )
-                                exit_status = self.responseQueue.get()
-                        else:
-                                self.WorkerFunction( item, thread_name )
+                        if self.Concurrency is not None:
+                                self.Concurrency.acquire()
+                                if threading.current_thread().guiTerminateSignal:
+                                        self.Concurrency.release()
+                                        break
+                        try:
+                                if self.responseQueue is not None:
+                                        self.responseQueue.put( self.WorkerFunction( item, thread_name ) )
+                                        exit_status = self.responseQueue.get()
+                                else:
+                                        self.WorkerFunction( item, thread_name )
+                        finally:
+                                if self.Concurrency is not None:
+                                        self.Concurrency.release()
 
@@ -3,7 +3,7 @@
 class SetterArgs():
     
     def __init__(self, filename, update, upgrade, install_packages, install_src_packages, \
-                 src_build_dep, changelog, release, apt_backend, simulate=False):
+                 src_build_dep, changelog, release, apt_backend, simulate=False, inventory=False):
         self.set = filename
         
         # self.set_update is of type boolean
@@ -24,6 +24,7 @@ class SetterArgs():
         self.simulate=simulate
         
         self.generate_changelog = changelog
+        self.generate_inventory = inventory
     
     def __str__(self):
         print("self.set=",self.set)
@@ -39,19 +40,34 @@ class GetterArgs():
 
     def __init__(self, filename=None, bundle_file=None, socket_timeout=30, \
                     num_of_threads=1, disable_md5check=True, deb_bugs=False,
-                        download_dir=None, cache_dir=None, proxy_host=None, proxy_port=None, progress_bar=None, progress_label=None):
+                        download_dir=None, cache_dir=None, proxy_host=None, proxy_port=None, progress_bar=None, progress_label=None,
+                        engine="threads", host_connections=4, segments=1, segment_threshold=64,
+                        min_threads=1, max_threads=8, schedule="lpt", verify_cache=False,
+                        hardlink=False, compress_level=6, bundle_format=None, volume_size=None):
 
         self.get = filename
 
         # TODO: to be implemented in next revision
         self.socket_timeout = socket_timeout
         self.num_of_threads = num_of_threads
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.schedule = schedule
+        self.engine = engine
+        self.host_connections = host_connections
+        self.segments = segments
+        self.segment_threshold = segment_threshold
 
         self.bundle_file = bundle_file
+        self.compress_level = compress_level
+        self.bundle_format = bundle_format
+        self.volume_size = volume_size
         self.disable_md5check = disable_md5check
         self.deb_bugs = deb_bugs
         self.download_dir = download_dir
         self.cache_dir = cache_dir
+        self.verify_cache = verify_cache
+        self.hardlink = hardlink
         
         self.proxy_host = proxy_host
         self.proxy_port = proxy_port
@@ -93,6 +109,8 @@ class InstallerArgs():
         self.skip_changelog = skip_changelog
         self.allow_unauthenticated = allow_unauthenticated
         self.install_src_path = install_src_path
+        self.decompress_buffer = 1024
+        self.compressed_indexes = False
         
         self.progress_bar = progress_bar
         self.progress_label = progress_label
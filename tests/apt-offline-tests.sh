@@ -6,8 +6,25 @@ URI="/tmp/set-$PPID.uris"
 CACHE_DIR="/var/cache/apt/archives"
 DOWNLOAD_DIR="/tmp/apt-offline-tests-$PPID"
 BUNDLE_FILE="/tmp/apt-offline-tests-$PPID.zip"
+TAR_BUNDLE_FILE="/tmp/apt-offline-tests-$PPID.tar.xz"
+VOLUME_BUNDLE_FILE="/tmp/apt-offline-tests-volumes-$PPID.zip"
+FALLBACK_URI="/tmp/set-$PPID-fallback.uris"
 THREADS=5
 APT_OFFLINE="./apt-offline "
+FAILURES=0
+CHECK_DIR="/tmp/apt-offline-checks-$PPID"
+
+check () {
+	# check DESCRIPTION COMMAND [ARGS]: count a failure when COMMAND fails
+	DESCRIPTION=$1
+	shift
+	if "$@"; then
+		echo "PASS: $DESCRIPTION"
+	else
+		echo "FAIL: $DESCRIPTION"
+		FAILURES=$((FAILURES + 1))
+	fi
+}
 
 set_features () {
 	if [ ! -z $1 ]; then
@@ -52,6 +69,9 @@ set_features () {
 	echo "Executing command 'set $URI --src-build-dep --install-src-packages $DISLIKED_PACKAGES --release $RELEASE'"
 	$APT_OFFLINE set $URI --src-build-dep --install-src-packages $DISLIKED_PACKAGES --release $RELEASE
 
+	echo "Executing command 'set $URI --update --upgrade --inventory'"
+	$APT_OFFLINE set $URI --update --upgrade --inventory
+
 }
 
 get_features () {
@@ -64,6 +84,18 @@ get_features () {
 	echo "Executing command 'get $URI --threads $THREADS'"
 	$APT_OFFLINE get $URI --threads $THREADS
 
+	echo "Executing command 'get $URI --threads $THREADS --schedule fifo'"
+	$APT_OFFLINE get $URI --threads $THREADS --schedule fifo
+
+	echo "Executing command 'get $URI --threads auto --max-threads $THREADS'"
+	$APT_OFFLINE get $URI --threads auto --max-threads $THREADS
+
+	echo "Executing command 'get $URI --engine asyncio --host-connections $THREADS'"
+	$APT_OFFLINE get $URI --engine asyncio --host-connections $THREADS
+
+	echo "Executing command 'get $URI --threads $THREADS --segments 4 --segment-threshold 1'"
+	$APT_OFFLINE get $URI --threads $THREADS --segments 4 --segment-threshold 1
+
 	echo "Executing command 'get $URI --threads $THREADS --socket-timeout 30'"
 	$APT_OFFLINE get $URI --threads $THREADS --socket-timeout 30
 
@@ -73,6 +105,12 @@ get_features () {
 	echo "Executing command 'get $URI --threads $THREADS -d $DOWNLOAD_DIR --cache-dir $CACHE_DIR'"
 	$APT_OFFLINE get $URI --threads $THREADS -d $DOWNLOAD_DIR --cache-dir $CACHE_DIR
 
+	echo "Executing command 'get $URI --threads $THREADS -d $DOWNLOAD_DIR --cache-dir $CACHE_DIR --verify-cache'"
+	$APT_OFFLINE get $URI --threads $THREADS -d $DOWNLOAD_DIR --cache-dir $CACHE_DIR --verify-cache
+
+	echo "Executing command 'get $URI --threads $THREADS -d $DOWNLOAD_DIR --cache-dir $CACHE_DIR --hardlink'"
+	$APT_OFFLINE get $URI --threads $THREADS -d $DOWNLOAD_DIR --cache-dir $CACHE_DIR --hardlink
+
 	echo "Executing command 'get $URI --no-checksum -d $DOWNLOAD_DIR --cache-dir $CACHE_DIR'"
 	$APT_OFFLINE get $URI --no-checksum -d $DOWNLOAD_DIR --cache-dir $CACHE_DIR
 
@@ -82,6 +120,21 @@ get_features () {
 	echo "Executing command 'get $URI --bug-reports --threads $THREADS --bundle $BUNDLE_FILE -d $DOWNLOAD_DIR --cache-dir $CACHE_DIR'"
 	$APT_OFFLINE get $URI --threads $THREADS --bug-reports -d $DOWNLOAD_DIR --cache-dir $CACHE_DIR --bundle $BUNDLE_FILE
 
+	echo "Executing command 'get $URI --threads $THREADS --bundle $TAR_BUNDLE_FILE --cache-dir $CACHE_DIR'"
+	$APT_OFFLINE get $URI --threads $THREADS --cache-dir $CACHE_DIR --bundle $TAR_BUNDLE_FILE
+
+	echo "Executing command 'get $URI --threads $THREADS --bundle $VOLUME_BUNDLE_FILE --volume-size 100M --cache-dir $CACHE_DIR'"
+	$APT_OFFLINE get $URI --threads $THREADS --cache-dir $CACHE_DIR --bundle $VOLUME_BUNDLE_FILE --volume-size 100M
+
+	#INFO: Ask for an index format the mirror doesn't serve, so that the other formats get fetched instead
+	sed "s/\(Packages\|Sources\)\.\(xz\|gz\|bz2\)'/\1.lzma'/" $URI > $FALLBACK_URI
+
+	echo "Executing command 'get $FALLBACK_URI --threads $THREADS -d $DOWNLOAD_DIR'"
+	$APT_OFFLINE get $FALLBACK_URI --threads $THREADS -d $DOWNLOAD_DIR
+
+	echo "Executing command 'get $FALLBACK_URI --engine asyncio -d $DOWNLOAD_DIR'"
+	$APT_OFFLINE get $FALLBACK_URI --engine asyncio -d $DOWNLOAD_DIR
+
 }
 
 install_features () {
@@ -112,6 +165,15 @@ install_features () {
 
 	echo "Executing command 'install $BUNDLE_FILE --skip-bug-reports --allow-unauthenticated'"
 	$APT_OFFLINE install $BUNDLE_FILE --simulate --skip-bug-reports  --allow-unauthenticated
+
+	echo "Executing command 'install $BUNDLE_FILE --simulate --skip-bug-reports --decompress-buffer 64'"
+	$APT_OFFLINE install $BUNDLE_FILE --simulate --skip-bug-reports --decompress-buffer 64
+
+	echo "Executing command 'install $BUNDLE_FILE --simulate --skip-bug-reports --compressed-indexes'"
+	$APT_OFFLINE install $BUNDLE_FILE --simulate --skip-bug-reports --compressed-indexes
+
+	echo "Executing command 'install - --simulate --skip-bug-reports < $TAR_BUNDLE_FILE'"
+	$APT_OFFLINE install - --simulate --skip-bug-reports < $TAR_BUNDLE_FILE
 }
 
 install_features_prompt () {
@@ -144,6 +206,415 @@ install_features_prompt () {
 	$APT_OFFLINE install $BUNDLE_FILE --simulate --allow-unauthenticated
 }
 
+check_setup () {
+	# A local mirror, which serves byte ranges and logs the requests. Under
+	# /flaky/ every response breaks after 1000000 bytes, under /corrupt/
+	# every payload is damaged
+	rm -rf $CHECK_DIR
+	mkdir -p $CHECK_DIR/www/pool $CHECK_DIR/www/dists/sid/main/binary-amd64
+	cat > $CHECK_DIR/server.py <<'EOF'
+import http.server, os, re, socket, socketserver, sys
+
+ROOT = sys.argv[1]
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        (view, path) = re.match(r"/(flaky/|corrupt/)?(.*)", self.path).groups()
+        fileName = os.path.join(ROOT, "www", path)
+        if not os.path.isfile(fileName):
+            return self.reply(404, b"")
+        data = open(fileName, "rb").read()
+        if view == "corrupt/":
+            data = bytes(255 - byte for byte in data)
+        etag = '"%x-%x"' % (len(data), int(os.path.getmtime(fileName)))
+        headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+        code = 200
+        ranged = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if ranged and self.headers.get("If-Range", etag) == etag:
+            start = int(ranged.group(1))
+            end = int(ranged.group(2) or len(data) - 1)
+            if start >= len(data):
+                return self.reply(416, b"", {"Content-Range": "bytes */%d" % (len(data))})
+            code = 206
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, len(data))
+            data = data[start:end + 1]
+        self.reply(code, data, headers, view == "flaky/")
+
+    def reply(self, code, data, headers={}, flaky=False):
+        with open(os.path.join(ROOT, "requests.log"), "a") as log:
+            log.write("%s %s %d\n" % (self.path, self.headers.get("Range", "-"), code))
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(data)))
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if flaky and len(data) > 1000000:
+            self.wfile.write(data[:1000000])
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = True
+            return
+        self.wfile.write(data)
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+server = Server(("127.0.0.1", 0), Handler)
+with open(os.path.join(ROOT, "port"), "w") as port:
+    port.write(str(server.server_address[1]))
+server.serve_forever()
+EOF
+	python3 - $CHECK_DIR <<'EOF'
+import hashlib, lzma, os, sys
+
+www = os.path.join(sys.argv[1], "www")
+for (name, size) in (("foo_1.0_all.deb", 70000), ("bar_1.1_all.deb", 3000000), ("big_1.3_all.deb", 8000000)):
+    with open(os.path.join(www, "pool", name), "wb") as deb:
+        deb.write(b"!<arch>\n" + os.urandom(size))
+packages = "".join("Package: pkg%d\nVersion: 1.0\nArchitecture: all\nDescription: package %d\n\n" % (n, n) for n in range(5000))
+index = os.path.join(www, "dists", "sid", "main", "binary-amd64", "Packages")
+with open(index + ".xz", "wb") as xz:
+    xz.write(lzma.compress(packages.encode()))
+with open(os.path.join(www, "dists", "sid", "Release"), "w") as release:
+    release.write("Origin: Check\nSuite: sid\nDate: Sat, 17 Oct 2026 00:00:00 UTC\nSHA256:\n")
+    for (data, path) in ((packages.encode(), "main/binary-amd64/Packages"), (open(index + ".xz", "rb").read(), "main/binary-amd64/Packages.xz")):
+        release.write(" %s %d %s\n" % (hashlib.sha256(data).hexdigest(), len(data), path))
+EOF
+	python3 $CHECK_DIR/server.py $CHECK_DIR &
+	CHECK_SERVER=$!
+	while [ ! -s $CHECK_DIR/port ]; do sleep 0.1; done
+	CHECK_URL="http://127.0.0.1:`cat $CHECK_DIR/port`"
+}
+
+check_teardown () {
+	kill $CHECK_SERVER
+	rm -rf $CHECK_DIR
+}
+
+check_sig () {
+	# check_sig VIEW FILE...: a signature file of the FILEs of the local mirror, under VIEW
+	VIEW=$1
+	shift
+	for FILE in "$@"; do
+		case $FILE in
+			*.deb)
+				echo "'$CHECK_URL/$VIEW$FILE' `basename $FILE` `stat -c %s $CHECK_DIR/www/$FILE` SHA256:`sha256sum $CHECK_DIR/www/$FILE | cut -d' ' -f1`"
+				;;
+			*)
+				echo "'$CHECK_URL/$VIEW$FILE' 127.0.0.1_`dirname $FILE | tr / _`_`basename $FILE | cut -d. -f1` 0 :"
+				;;
+		esac
+	done
+}
+
+check_partial_install () {
+	# An interrupted download leaves big_1.3_all.deb incomplete, which isn't installed
+	check_sig flaky/ pool/foo_1.0_all.deb pool/big_1.3_all.deb > $CHECK_DIR/partial.sig
+	$APT_OFFLINE get $CHECK_DIR/partial.sig -d $CHECK_DIR/partial > /dev/null 2>&1
+	[ -f $CHECK_DIR/partial/big_1.3_all.deb.apt-offline-partial ] || return 1
+	$APT_OFFLINE install $CHECK_DIR/partial --simulate --skip-changelog --skip-bug-reports --verbose > $CHECK_DIR/install.log 2>&1
+	TARGET=`sed -n 's/.*apt-package-target-path is \(.*\)$/\1/p' $CHECK_DIR/install.log`
+	RESULT=0
+	[ -f $TARGET/foo_1.0_all.deb ] && [ ! -e $TARGET/big_1.3_all.deb ] || RESULT=1
+	rm -rf $TARGET `sed -n 's/.*apt-update-\(target\|final\)-path is \(.*\)$/\2/p' $CHECK_DIR/install.log`
+	return $RESULT
+}
+
+check_payload () {
+	# check_payload DIR FILE: FILE was downloaded into DIR whole and intact
+	[ ! -e $CHECK_DIR/$1/$2.apt-offline-partial ] && cmp -s $CHECK_DIR/$1/$2 $CHECK_DIR/www/pool/$2
+}
+
+check_resume () {
+	# The second run resumes the partial file of the first one with If-Range
+	check_sig flaky/ pool/big_1.3_all.deb > $CHECK_DIR/resume.sig
+	$APT_OFFLINE get $CHECK_DIR/resume.sig -d $CHECK_DIR/resume > /dev/null 2>&1
+	[ -f $CHECK_DIR/resume/big_1.3_all.deb.apt-offline-partial ] || return 1
+	: > $CHECK_DIR/requests.log
+	$APT_OFFLINE get $CHECK_DIR/resume.sig -d $CHECK_DIR/resume --verbose > $CHECK_DIR/resume.log 2>&1
+	grep -q "Resuming .*big_1.3_all.deb at 5000000 bytes" $CHECK_DIR/resume.log || return 1
+	head -n 1 $CHECK_DIR/requests.log | grep -q "bytes=5000000- 206" && check_payload resume big_1.3_all.deb
+}
+
+check_partial_state () {
+	# check_partial_state DIR FILE SIZE: pretend an earlier run left SIZE bytes of FILE in DIR
+	mkdir -p $CHECK_DIR/$1
+	head -c $3 $CHECK_DIR/www/pool/$2 > $CHECK_DIR/$1/$2
+	python3 -c 'import json, os, sys; json.dump({"url": sys.argv[1], "validator": "\"%x-%x\"" % (os.path.getsize(sys.argv[2]), int(os.path.getmtime(sys.argv[2])))}, sys.stdout)' \
+		$CHECK_URL/pool/$2 $CHECK_DIR/www/pool/$2 > $CHECK_DIR/$1/$2.apt-offline-partial
+}
+
+check_unsatisfiable () {
+	# A partial file as big as the payload gets a 416, and is downloaded again whole
+	SIZE=`stat -c %s $CHECK_DIR/www/pool/bar_1.1_all.deb`
+	check_partial_state unsatisfiable bar_1.1_all.deb $SIZE
+	check_sig "" pool/bar_1.1_all.deb > $CHECK_DIR/unsatisfiable.sig
+	: > $CHECK_DIR/requests.log
+	$APT_OFFLINE get $CHECK_DIR/unsatisfiable.sig -d $CHECK_DIR/unsatisfiable > /dev/null 2>&1
+	grep -q "bytes=$SIZE- 416" $CHECK_DIR/requests.log && grep -q "bar_1.1_all.deb - 200" $CHECK_DIR/requests.log && check_payload unsatisfiable bar_1.1_all.deb
+}
+
+check_stale_resume () {
+	# A resumed partial file whose head is damaged fails the checksum, and is downloaded again from byte 0
+	check_partial_state stale bar_1.1_all.deb 1000000
+	printf 'damaged' | dd of=$CHECK_DIR/stale/bar_1.1_all.deb bs=1 seek=100 conv=notrunc 2> /dev/null
+	check_sig "" pool/bar_1.1_all.deb > $CHECK_DIR/stale.sig
+	: > $CHECK_DIR/requests.log
+	$APT_OFFLINE get $CHECK_DIR/stale.sig -d $CHECK_DIR/stale > /dev/null 2>&1
+	grep -q "bytes=1000000- 206" $CHECK_DIR/requests.log && grep -q "bar_1.1_all.deb - 200" $CHECK_DIR/requests.log && check_payload stale bar_1.1_all.deb
+}
+
+check_segmented_fallback () {
+	# A damaged segmented download falls back to a plain one, which is counted once in the progress bar
+	check_sig corrupt/ pool/big_1.3_all.deb > $CHECK_DIR/segmented.sig
+	for ENGINE in threads asyncio; do
+		$APT_OFFLINE get $CHECK_DIR/segmented.sig -d $CHECK_DIR/segmented-$ENGINE --engine $ENGINE --segments 4 --segment-threshold 1 > $CHECK_DIR/segmented.log 2>&1
+		tr '\r' '\n' < $CHECK_DIR/segmented.log | grep -a "items:" > $CHECK_DIR/progress.log
+		[ -s $CHECK_DIR/progress.log ] && ! grep -qv " 1 items:.* of 7 MiB" $CHECK_DIR/progress.log || return 1
+	done
+}
+
+check_volume_size () {
+	# Many small files, incompressible and with long names, packed in volumes of every format
+	python3 - $CHECK_DIR <<'EOF'
+import json, os, sys, tarfile, zipfile
+sys.path.insert(0, ".")
+from apt_offline_core.AptOfflineLib import BundleWriter, TarBundleWriter
+
+work = os.path.join(sys.argv[1], "volumes")
+os.makedirs(work)
+names = []
+for n in range(1200):
+    if n % 2:
+        name = "%s_%d_all.deb" % ("p" * (n % 150), n)
+    else:
+        name = "file%d.txt" % (n)
+    with open(os.path.join(work, name), "wb") as data:
+        data.write(os.urandom(n * 37 % 4000))
+    names.append(name)
+
+Cap = 1024 * 1024
+for bundleFormat in ("zip", "tar", "tar.gz", "tar.bz2", "tar.xz"):
+    bundle = os.path.join(work, "bundle." + bundleFormat)
+    if bundleFormat == "zip":
+        writer = BundleWriter(bundle, volume_size=Cap)
+    else:
+        writer = TarBundleWriter(bundle, bundle_format=bundleFormat, volume_size=Cap)
+    for name in names:
+        writer.add(os.path.join(work, name))
+    writer.close()
+    assert writer.errors == [], writer.errors
+    packed = []
+    for volume in writer.volumes:
+        assert os.path.getsize(volume["name"]) <= Cap, (volume["name"], os.path.getsize(volume["name"]))
+        if bundleFormat == "zip":
+            manifest = zipfile.ZipFile(volume["name"]).read(BundleWriter.manifest_name)
+        else:
+            manifest = tarfile.open(volume["name"]).extractfile(BundleWriter.manifest_name).read()
+        packed += [entry["name"] for entry in json.loads(manifest)["files"]]
+    assert sorted(packed) == sorted(names), bundleFormat
+EOF
+}
+
+check_bug_bundle () {
+	# check_bug_bundle DIR: a deb and a bug report of it, in DIR
+	mkdir -p $CHECK_DIR/$1
+	cp $CHECK_DIR/www/pool/foo_1.0_all.deb $CHECK_DIR/$1
+	printf 'Subject: foo: crashes on start\n\nIt does\n' > "$CHECK_DIR/$1/foo{}123456{}__apt__bug__report"
+}
+
+check_manifest () {
+	# The manifest describes each member of the bundle
+	check_bug_bundle manifest
+	python3 - $CHECK_DIR <<'EOF'
+import hashlib, json, os, sys, zipfile
+sys.path.insert(0, ".")
+from apt_offline_core.AptOfflineLib import BundleWriter
+
+work = os.path.join(sys.argv[1], "manifest")
+writer = BundleWriter(os.path.join(sys.argv[1], "manifest.zip"), bug_suffix="__apt__bug__report")
+for name in sorted(os.listdir(work)):
+    writer.add(os.path.join(work, name))
+writer.close()
+files = json.loads(zipfile.ZipFile(os.path.join(sys.argv[1], "manifest.zip")).read(BundleWriter.manifest_name))["files"]
+deb = open(os.path.join(work, "foo_1.0_all.deb"), "rb").read()
+assert files[0] == {"name": "foo_1.0_all.deb", "size": len(deb), "format": "deb", "role": "deb", "package": "foo",
+                    "version": "1.0", "sha256": hashlib.sha256(deb).hexdigest()}, files[0]
+assert (files[1]["role"], files[1]["package"], files[1]["subject"]) == ("bug", "foo", "foo: crashes on start"), files[1]
+EOF
+}
+
+check_bug_subject () {
+	# The bug reports of a tar bundle are listed by their subject, as in the manifest
+	check_bug_bundle subject
+	tar cf $CHECK_DIR/subject.tar -C $CHECK_DIR/subject .
+	$APT_OFFLINE install $CHECK_DIR/subject.tar --simulate --skip-changelog --verbose > $CHECK_DIR/install.log 2>&1
+	rm -rf `sed -n 's/.*apt-\(package\|update\)-\(target\|final\)-path is \(.*\)$/\3/p' $CHECK_DIR/install.log`
+	grep -qa "__apt__bug__report: foo: crashes on start" $CHECK_DIR/install.log && ! grep -qa "report: Subject:" $CHECK_DIR/install.log
+}
+
+check_mirror_failover () {
+	# A mirror that serves a damaged package is given up on for the next one
+	(check_sig corrupt/ pool/bar_1.1_all.deb; check_sig "" pool/bar_1.1_all.deb) > $CHECK_DIR/failover.sig
+	: > $CHECK_DIR/requests.log
+	$APT_OFFLINE get $CHECK_DIR/failover.sig -d $CHECK_DIR/failover > /dev/null 2>&1
+	grep -q "^/corrupt/pool/bar_1.1_all.deb - 200" $CHECK_DIR/requests.log && grep -q "^/pool/bar_1.1_all.deb - 200" $CHECK_DIR/requests.log && \
+		check_payload failover bar_1.1_all.deb
+}
+
+check_delta () {
+	# The offline machine has foo, an older bar, and the unchanged Release and Packages
+	RELEASE=$CHECK_DIR/www/dists/sid/Release
+	check_sig "" pool/foo_1.0_all.deb pool/bar_1.1_all.deb dists/sid/Release dists/sid/main/binary-amd64/Packages.xz > $CHECK_DIR/delta.sig
+	cat >> $CHECK_DIR/delta.sig <<EOF
+Inventory/foo_1.0_all.deb/`stat -c %s $CHECK_DIR/www/pool/foo_1.0_all.deb`/`sha256sum $CHECK_DIR/www/pool/foo_1.0_all.deb | cut -d' ' -f1`/-
+Inventory/bar_1.1_all.deb/`stat -c %s $CHECK_DIR/www/pool/bar_1.1_all.deb`/`sha256sum $CHECK_DIR/www/pool/foo_1.0_all.deb | cut -d' ' -f1`/-
+Inventory/127.0.0.1_dists_sid_Release/1/0000/`sed -n 's/^Date: //p' $RELEASE`
+Inventory/127.0.0.1_dists_sid_main_binary-amd64_Packages/1/`awk '$3 == "main/binary-amd64/Packages" {print $1}' $RELEASE`/-
+EOF
+	: > $CHECK_DIR/requests.log
+	$APT_OFFLINE get $CHECK_DIR/delta.sig -d $CHECK_DIR/delta > $CHECK_DIR/delta.log 2>&1
+	grep -q "3 of 4 items are already on the offline machine" $CHECK_DIR/delta.log && \
+		[ "`ls $CHECK_DIR/delta`" = "bar_1.1_all.deb" ] && ! grep -q "foo_1.0_all.deb\|Packages" $CHECK_DIR/requests.log || return 1
+
+	# Then its Release is older, and its Packages differs
+	sed -i 's/^\(Inventory\/127.0.0.1_dists_sid_Release\/.*\/\)[^/]*$/\1Fri, 16 Oct 2026 00:00:00 UTC/; s/^\(Inventory\/.*_Packages\/1\/\)[0-9a-f]*/\10000/' $CHECK_DIR/delta.sig
+	$APT_OFFLINE get $CHECK_DIR/delta.sig -d $CHECK_DIR/delta-changed > $CHECK_DIR/delta.log 2>&1
+	grep -q "1 of 4 items are already on the offline machine" $CHECK_DIR/delta.log && \
+		[ -f $CHECK_DIR/delta-changed/127.0.0.1_dists_sid_Release ] && [ ! -f $CHECK_DIR/delta-changed/foo_1.0_all.deb ] && \
+		ls $CHECK_DIR/delta-changed | grep -q "_Packages"
+}
+
+check_cache_index () {
+	# The saved listing of a cache directory is dropped once a file is added under it
+	mkdir -p $CHECK_DIR/cache/sub
+	cp $CHECK_DIR/www/pool/foo_1.0_all.deb $CHECK_DIR/cache
+	check_sig "" pool/foo_1.0_all.deb > $CHECK_DIR/cache-foo.sig
+	check_sig "" pool/bar_1.1_all.deb > $CHECK_DIR/cache-bar.sig
+	: > $CHECK_DIR/requests.log
+	XDG_CACHE_HOME=$CHECK_DIR/xdg $APT_OFFLINE get $CHECK_DIR/cache-foo.sig --cache-dir $CHECK_DIR/cache -d $CHECK_DIR/cached > /dev/null 2>&1
+	cp $CHECK_DIR/www/pool/bar_1.1_all.deb $CHECK_DIR/cache/sub
+	XDG_CACHE_HOME=$CHECK_DIR/xdg $APT_OFFLINE get $CHECK_DIR/cache-bar.sig --cache-dir $CHECK_DIR/cache -d $CHECK_DIR/cached > /dev/null 2>&1
+	[ ! -s $CHECK_DIR/requests.log ] && check_payload cached foo_1.0_all.deb && check_payload cached bar_1.1_all.deb
+}
+
+check_fingerprint_get () {
+	# check_fingerprint_get RUN: get foo through the cache directory, in verbose
+	: > $CHECK_DIR/requests.log
+	XDG_CACHE_HOME=$CHECK_DIR/xdg $APT_OFFLINE get $CHECK_DIR/fingerprint.sig --cache-dir $CHECK_DIR/fingerprint \
+		-d $CHECK_DIR/fingerprint-$1 --verbose > $CHECK_DIR/fingerprint.log 2>&1
+	check_payload fingerprint-$1 foo_1.0_all.deb
+}
+
+check_fingerprint () {
+	# A cached package is trusted without hashing it until its size, mtime or inode change
+	CACHED=$CHECK_DIR/fingerprint/foo_1.0_all.deb
+	mkdir -p $CHECK_DIR/fingerprint
+	cp $CHECK_DIR/www/pool/foo_1.0_all.deb $CACHED
+	check_sig "" pool/foo_1.0_all.deb > $CHECK_DIR/fingerprint.sig
+	check_fingerprint_get 1 && check_fingerprint_get 2 && grep -q "unchanged since its last verification" $CHECK_DIR/fingerprint.log || return 1
+
+	# A damaged copy with the same size and mtime, but another inode
+	cp $CACHED $CHECK_DIR/damaged
+	printf 'damaged' | dd of=$CHECK_DIR/damaged bs=1 seek=100 conv=notrunc 2> /dev/null
+	touch -r $CACHED $CHECK_DIR/damaged
+	mv $CHECK_DIR/damaged $CACHED
+	check_fingerprint_get 3 && ! grep -q "unchanged since its last verification" $CHECK_DIR/fingerprint.log && \
+		grep -q "^/pool/foo_1.0_all.deb - 200" $CHECK_DIR/requests.log || return 1
+
+	# Damaged in place, with the same size and inode, but another mtime
+	check_fingerprint_get 4 && grep -q "unchanged since its last verification" $CHECK_DIR/fingerprint.log || return 1
+	printf 'damaged' | dd of=$CACHED bs=1 seek=100 conv=notrunc 2> /dev/null
+	check_fingerprint_get 5 && ! grep -q "unchanged since its last verification" $CHECK_DIR/fingerprint.log && \
+		grep -q "^/pool/foo_1.0_all.deb - 200" $CHECK_DIR/requests.log
+}
+
+check_stored_debs () {
+	# The debs of a zip bundle are stored as they are, the indexes are deflated
+	check_sig "" pool/foo_1.0_all.deb pool/bar_1.1_all.deb dists/sid/Release > $CHECK_DIR/stored.sig
+	$APT_OFFLINE get $CHECK_DIR/stored.sig --bundle $CHECK_DIR/stored.zip > /dev/null 2>&1
+	unzip -v $CHECK_DIR/stored.zip > $CHECK_DIR/stored.log || return 1
+	[ `awk '$NF ~ /\.deb$/ && $2 == "Stored"' $CHECK_DIR/stored.log | wc -l` -eq 2 ] && \
+		awk '$NF == "127.0.0.1_dists_sid_Release"' $CHECK_DIR/stored.log | grep -q "Defl:"
+}
+
+check_index_install () {
+	# check_index_install [OPTION]: install the indexes got by check_compressed_indexes, and list the apt lists
+	$APT_OFFLINE install $CHECK_DIR/indexes --simulate --allow-unauthenticated --skip-changelog --skip-bug-reports --verbose $1 > $CHECK_DIR/install.log 2>&1
+	FINAL=`sed -n 's/.*apt-update-final-path is \(.*\)$/\1/p' $CHECK_DIR/install.log`
+	ls $FINAL
+	rm -rf `sed -n 's/.*apt-\(package\|update\)-\(target\|final\)-path is \(.*\)$/\3/p' $CHECK_DIR/install.log`
+}
+
+check_compressed_indexes () {
+	# The lists are installed uncompressed, or as the xz apt can read with --compressed-indexes
+	check_sig "" dists/sid/Release dists/sid/main/binary-amd64/Packages.xz > $CHECK_DIR/indexes.sig
+	$APT_OFFLINE get $CHECK_DIR/indexes.sig -d $CHECK_DIR/indexes > /dev/null 2>&1
+	[ "`check_index_install | grep _Packages`" = "127.0.0.1_dists_sid_main_binary-amd64_Packages" ] && \
+		[ "`check_index_install --compressed-indexes | grep _Packages`" = "127.0.0.1_dists_sid_main_binary-amd64_Packages.xz" ]
+}
+
+check_concurrency () {
+	# A synthetic byte counter and error rate, one interval at a time
+	python3 - <<'EOF'
+import sys
+sys.path.insert(0, ".")
+from apt_offline_core.AptOfflineLib import AdaptiveConcurrency, ByteCounter
+
+counter = ByteCounter()
+controller = AdaptiveConcurrency(counter, minimum=1, maximum=8, interval=1.0)
+
+def interval(received, errors=0, started=10):
+    counter.add(received)
+    controller.errors = errors
+    controller.started = started
+    controller.lastTime -= controller.interval
+    with controller.condition:
+        controller.adjust()
+    return controller.limit
+
+MiB = 1024 * 1024
+limits = [interval(1 * MiB), interval(2 * MiB)]
+assert limits == [2, 3], limits
+# The third worker didn't pay off: back off, and hold
+limits = [interval(2 * MiB) for n in range(4)]
+assert limits == [2, 2, 2, 2], limits
+assert interval(2 * MiB) == 3
+# Retries: halve, but never below the minimum
+assert interval(2 * MiB, errors=5) == 1
+assert interval(2 * MiB, errors=5) == 1
+EOF
+}
+
+check_features () {
+	check "adaptive concurrency increases, backs off and halves" check_concurrency
+
+	check_setup
+	check "every volume of a bundle is within the volume size" check_volume_size
+	check "the manifest describes the members of a bundle" check_manifest
+	check "bug reports of a tar bundle are listed by their subject" check_bug_subject
+	check "install skips the payload of an incomplete download" check_partial_install
+	check "a partial download is resumed with If-Range" check_resume
+	check "a 416 response discards the partial download" check_unsatisfiable
+	check "a damaged resumed download is fetched again from the start" check_stale_resume
+	check "a segmented download that falls back is counted once" check_segmented_fallback
+	check "a damaged download fails over to the next mirror" check_mirror_failover
+	check "get leaves out what the inventory lists" check_delta
+	check "the cache directory listing is kept until the directory changes" check_cache_index
+	check "a cached package is hashed again once it changes" check_fingerprint
+	check "debs are stored uncompressed in a zip bundle" check_stored_debs
+	check "indexes are installed compressed only with --compressed-indexes" check_compressed_indexes
+	check_teardown
+
+	echo "$FAILURES check(s) failed"
+	[ $FAILURES -eq 0 ]
+}
+
 all_features () {
 	echo "Executing function set_features"
 	set_features
@@ -153,6 +624,9 @@ all_features () {
 
 	echo "Executing function install_features"
 	install_features
+
+	echo "Executing function check_features"
+	check_features
 }
 
 case $1 in
@@ -185,12 +659,16 @@ case $1 in
 			install_features_prompt
 		fi
 		;;
+	"check")
+		check_features
+		exit $?
+		;;
 	"--help")
-		echo "$0 [set || get || install_features_promptless || install]"
+		echo "$0 [set || get || install_features_promptless || install || check]"
 		exit 0;
 		;;
 	"-h")
-		echo "$0 [set || get || install_features_promptless || install]"
+		echo "$0 [set || get || install_features_promptless || install || check]"
 		exit 0;
 		;;
 	*)